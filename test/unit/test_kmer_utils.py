@@ -4,16 +4,22 @@ __author__ = "ilya@broadinstitute.org"
 
 import os
 import sys
+import io
+import gzip
 import collections
 import argparse
 import logging
 import itertools
+import functools
 import unittest
+import concurrent.futures
 
+import numpy
 import Bio.SeqIO
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
-from Bio.Alphabet import IUPAC
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 import pytest
 
 import kmer_utils
@@ -38,6 +44,12 @@ class TestCommandHelp(unittest.TestCase):
 # Some general utils used below #
 #################################
 
+# extensions of sequence files accepted wherever sequences are given
+_SEQ_FILE_EXTS = ('.fasta', '.fasta.gz', '.fastq', '.fastq.gz', '.bam')
+
+# translation table for complementing bases
+_RC_TRANS = str.maketrans('ACGTacgt', 'TGCAtgca')
+
 def _seq_as_str(s):  # pylint: disable=invalid-name
     """Return a sequence as a str, regardless of whether it was a str, a Seq or a SeqRecord"""
     if isinstance(s, Seq):
@@ -46,20 +58,51 @@ def _seq_as_str(s):  # pylint: disable=invalid-name
         return str(s.seq)
     return s
 
+def _open_seq_file(seq_file):
+    """Open a (possibly compressed) sequence file for reading as text.  gzipped files are read through a 1MB buffer,
+    so that decompression happens in large chunks rather than one small read at a time."""
+    if seq_file.endswith('.gz'):
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(seq_file, 'rb'), buffer_size=1 << 20))
+    return util.file.open_or_gzopen(seq_file, 'rt')
+
+@functools.lru_cache(maxsize=None)
+def _bam_seq_recs(bam, mtime):  # pylint: disable=unused-argument
+    """Return a tuple of the sequence records in a bam file.  Since the bam-to-fasta conversion is costly and the same
+    inputs are used by many tests, results are cached; `mtime` is the bam's modification time, so that a modified
+    bam is not served from the cache."""
+    with util.file.tmp_dir(suffix='_bam2fa') as t_dir:
+        t_fa = os.path.join(t_dir, 'bam2fa.fasta')
+        tools.samtools.SamtoolsTool().bam2fa(bam, t_fa, append_mate_num=True)
+        return tuple(Bio.SeqIO.parse(t_fa, 'fasta'))
+
 def _yield_seq_recs(seq_file):
     """Yield sequence records from the file, regardless of file format."""
-    with util.file.tmp_dir(suffix='_seqs_as_strs') as t_dir:
-        if seq_file.endswith('.bam'):
-            t_fa = os.path.join(t_dir, 'bam2fa.fasta')
-            tools.samtools.SamtoolsTool().bam2fa(seq_file, t_fa, append_mate_num=True)
-            seq_file = t_fa
-        with util.file.open_or_gzopen(seq_file, 'rt') as seq_f:
-            for rec in Bio.SeqIO.parse(seq_f, util.file.uncompressed_file_type(seq_file)[1:]):
-                yield rec
-
-def _list_seq_recs(seq_file):
-    """Return a list of sequence records from the file, regardless of file format."""
-    return list(_yield_seq_recs(seq_file))
+    if seq_file.endswith('.bam'):
+        for rec in _bam_seq_recs(os.path.abspath(seq_file), os.path.getmtime(seq_file)):
+            yield rec
+        return
+    with _open_seq_file(seq_file) as seq_f:
+        for rec in Bio.SeqIO.parse(seq_f, util.file.uncompressed_file_type(seq_file)[1:]):
+            yield rec
+
+def _yield_seq_file_strs(seq_file):
+    """Yield the sequences in the file as strs, regardless of file format.  Fasta and fastq files are read with
+    Biopython's low-level parsers, which yield strs without constructing a SeqRecord for each sequence."""
+    if seq_file.endswith('.bam'):
+        for rec in _bam_seq_recs(os.path.abspath(seq_file), os.path.getmtime(seq_file)):
+            yield str(rec.seq)
+        return
+    file_type = util.file.uncompressed_file_type(seq_file)
+    with _open_seq_file(seq_file) as seq_f:
+        if file_type == '.fasta':
+            for _title, seq in SimpleFastaParser(seq_f):
+                yield seq
+        elif file_type == '.fastq':
+            for _title, seq, _qual in FastqGeneralIterator(seq_f):
+                yield seq
+        else:
+            for rec in Bio.SeqIO.parse(seq_f, file_type[1:]):
+                yield str(rec.seq)
 
 
 def _yield_seqs_as_strs(seqs):
@@ -67,11 +110,11 @@ def _yield_seqs_as_strs(seqs):
     or an iterable of these.  If a filename of a sequence file, all sequences from that file are yielded."""
     for seq in util.misc.make_seq(seqs, (str, SeqRecord, Seq)):
         seq = _seq_as_str(seq)
-        if not any(seq.endswith(ext) for ext in '.fasta .fasta.gz .fastq .fastq.gz .bam'):
+        if not seq.endswith(_SEQ_FILE_EXTS):
             yield seq
         else:
-            for rec in _yield_seq_recs(seq):
-                yield str(rec.seq)
+            for seq_str in _yield_seq_file_strs(seq):
+                yield seq_str
 
 def _list_seqs_as_strs(seqs):
     """Return a list of sequence(s) from `seqs` as strs.  seqs can be a str/SeqRecord/Seq, a filename of a sequence file,
@@ -98,54 +141,126 @@ class KmcPy(object):
     ( https://github.com/refresh-bio/KMC/issues/55 ).
     """
 
-    def _revcomp(self, kmer):
-        """Return the reverse complement of a kmer, given as a string"""
-        assert isinstance(kmer, str)
-        return str(Seq(kmer, IUPAC.unambiguous_dna).reverse_complement())
+    # complements of bases, indexed by ASCII value; other characters map to themselves
+    _BASE_COMPLEMENTS = numpy.arange(256, dtype=numpy.uint8)
+    _BASE_COMPLEMENTS[list(_RC_TRANS.keys())] = list(_RC_TRANS.values())
+
+    # 2-bit codes of bases, indexed by ASCII value; characters other than TCGA (in either case) map to 4
+    _BASE_CODES = numpy.full(256, 4, dtype=numpy.uint8)
+    _BASE_CODES[numpy.frombuffer(b'ACGTacgt', dtype=numpy.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+    # longest kmer that can be packed, at 2 bits per base, into a numpy.uint64
+    _MAX_PACKED_KMER_SIZE = 32
 
-    def _canonicalize(self, kmer):
-        """Return the canonical version of a kmer"""
-        return min(kmer, self._revcomp(kmer))
+    def _encode_2bit(self, seq):
+        """Return the 2-bit codes (A=0,C=1,G=2,T=3) of the bases of a sequence given as a str, as a numpy.uint8 array.
+        Non-TCGA bases are coded as 4."""
+        return self._BASE_CODES[numpy.frombuffer(seq.encode('ascii'), dtype=numpy.uint8)]
 
-    def _compute_kmers_iter(self, seq_strs, kmer_size, single_strand, **ignore):
-        """Yield kmers of seq(s).  Unless `single_strand` is True, each kmer
-        is canonicalized before being returned.  Note that
-        deduplication is not done, so each occurrence of each kmer is
-        yielded.  Kmers containing non-TCGA bases are skipped.
+    def _packed_kmers(self, base_codes, kmer_size):
+        """Given the 2-bit codes of a sequence's bases, return a pair of numpy.uint64 arrays containing, for each kmer
+        window, the kmer and its reverse complement packed into integers with the first base in the most significant
+        bits.  Packed values for windows containing non-TCGA bases are meaningless.
+
+        The packed values are built up by the rolling recurrences fwd = (fwd << 2) | base and
+        rc = rc | (complement(base) << 2*j), evaluated for all windows at once, one base position j at a time.
+        """
+        n_kmers = len(base_codes)-kmer_size+1
+        base_codes = base_codes.astype(numpy.uint64)
+        fwd = numpy.zeros(n_kmers, dtype=numpy.uint64)
+        rc = numpy.zeros(n_kmers, dtype=numpy.uint64)
+        for j in range(kmer_size):
+            window_bases = base_codes[j:j+n_kmers]
+            fwd = (fwd << numpy.uint64(2)) | window_bases
+            rc |= (window_bases ^ numpy.uint64(3)) << numpy.uint64(2*j)
+        return fwd, rc
+
+    def _kmers_dtype(self, kmer_size):
+        """Return the numpy dtype used to represent kmers of the given size: packed integers if they fit,
+        else fixed-width byte strings"""
+        return numpy.uint64 if kmer_size <= self._MAX_PACKED_KMER_SIZE else 'S{}'.format(kmer_size)
+
+    def _kmers_as_strs(self, kmers, kmer_size):
+        """Return a list of kmers, given as an array returned by _compute_kmers(), as strs"""
+        if kmers.dtype != numpy.uint64:
+            return [kmer.decode('ascii') for kmer in kmers]
+        shifts = numpy.arange(2*(kmer_size-1), -1, -2, dtype=numpy.uint64)
+        base_codes = ((kmers[:, numpy.newaxis] >> shifts) & numpy.uint64(3)).astype(numpy.uint8)
+        kmer_bytes = numpy.frombuffer(b'ACGT', dtype=numpy.uint8)[base_codes]
+        return [kmer.decode('ascii') for kmer in kmer_bytes.view('S{}'.format(kmer_size)).ravel()]
+
+    def _compute_seq_kmers(self, seq, kmer_size, single_strand):
+        """Return an array of the kmers of one seq, represented as per _kmers_dtype().  Unless `single_strand` is True,
+        each kmer is canonicalized.  Note that deduplication is not done, so each occurrence of each kmer is included.
+        Kmers containing non-TCGA bases are skipped.
         """
-        for seq in seq_strs:
-            n_kmers = len(seq)-kmer_size+1
-
-            # mark kmers containing invalid base(s)
-            valid_kmer = [True] * n_kmers
-            for i in range(len(seq)):  # pylint: disable=consider-using-enumerate
-                if seq[i].upper() not in 'TCGA':
-                    invalid_lo = max(0, i-kmer_size+1)
-                    invalid_hi = min(n_kmers, i+1)
-                    valid_kmer[invalid_lo:invalid_hi] = [False]*(invalid_hi-invalid_lo)
-
-            for i in range(n_kmers):
-                if valid_kmer[i]:
-                    kmer = seq[i:i+kmer_size]
-                    yield kmer if single_strand else self._canonicalize(kmer)
-
-    def _compute_kmers(self, *args, **kw):
-        """Return list of kmers of seq(s).  Unless `single_strand` is True, each kmer
-        is canonicalized before being returned.  Note that
-        deduplication is not done, so each occurrence of each kmer is
-        yielded.  Kmers containing non-TCGA bases are skipped.
+        n_kmers = len(seq)-kmer_size+1
+        if n_kmers <= 0:
+            return numpy.zeros(0, dtype=self._kmers_dtype(kmer_size))
+
+        # mark kmers containing invalid base(s): a kmer is valid iff the number of invalid bases
+        # in its window, taken as a difference of prefix sums, is zero
+        base_codes = self._encode_2bit(seq)
+        n_invalid_before = numpy.concatenate(([0], numpy.cumsum(base_codes > 3)))
+        valid_kmer = (n_invalid_before[kmer_size:] - n_invalid_before[:n_kmers]) == 0
+
+        if kmer_size <= self._MAX_PACKED_KMER_SIZE:
+            kmers, kmers_rc = self._packed_kmers(base_codes, kmer_size)
+            return kmers[valid_kmer] if single_strand else numpy.minimum(kmers, kmers_rc)[valid_kmer]
+
+        # kmers too long to pack are canonicalized all at once as byte strings: gather the valid windows into
+        # an (n_valid_kmers, kmer_size) array, and get their reverse complements by a table lookup on the
+        # windows with columns reversed
+        seq_bytes = numpy.frombuffer(seq.upper().encode('ascii'), dtype=numpy.uint8)
+        windows = numpy.lib.stride_tricks.as_strided(seq_bytes, shape=(n_kmers, kmer_size),
+                                                     strides=(seq_bytes.strides[0],)*2, writeable=False)[valid_kmer]
+        kmers = windows.view(self._kmers_dtype(kmer_size)).ravel()
+        if single_strand:
+            return kmers
+        kmers_rc = self._BASE_COMPLEMENTS[windows[:, ::-1]].view(self._kmers_dtype(kmer_size)).ravel()
+        return numpy.where(kmers <= kmers_rc, kmers, kmers_rc)
+
+    def _compute_kmers(self, seq_strs, kmer_size, single_strand, **ignore):
+        """Return an array of the kmers of seq(s), represented as per _kmers_dtype().  Unless `single_strand` is True,
+        each kmer is canonicalized.  Note that deduplication is not done, so each occurrence of each kmer is included.
+        Kmers containing non-TCGA bases are skipped.
         """
-        return list(self._compute_kmers_iter(*args, **kw))
+        return numpy.concatenate([numpy.zeros(0, dtype=self._kmers_dtype(kmer_size))] +
+                                 [self._compute_seq_kmers(seq, kmer_size, single_strand) for seq in seq_strs])
 
     def compute_kmer_counts(self, seq_files, kmer_size, min_occs, max_occs,
-                            counter_cap, single_strand, **ignore):
+                            counter_cap, single_strand, threads=None, **ignore):
         """Yield kmer counts of seq(s).  Unless `single_strand` is True, each kmer is
         canonicalized before being counted.  Kmers containing non-TCGA bases are skipped.
         Kmers with fewer than `min_occs` or more than `max_occs` occurrences
         are dropped, and kmer counts capped at `counter_cap`, if these args are given.
+        If there are multiple seqs, up to `threads` processes are used to count the kmers.
         """
-        counts = collections.Counter(self._compute_kmers(_list_seqs_as_strs(seq_files), kmer_size, single_strand))
-        return self._filter_kmer_counts(counts=counts, min_occs=min_occs, max_occs=max_occs, counter_cap=counter_cap)
+        seq_strs = _list_seqs_as_strs(seq_files)
+        n_shards = min(util.misc.sanitize_thread_count(threads), len(seq_strs))
+        if n_shards > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_shards) as executor:
+                shard_counts = list(executor.map(functools.partial(_count_kmers, kmer_size=kmer_size,
+                                                                   single_strand=single_strand),
+                                                 [seq_strs[shard::n_shards] for shard in range(n_shards)]))
+            shard_kmers, shard_kmer_counts = zip(*shard_counts)
+            kmers, shard_kmer_idx = numpy.unique(numpy.concatenate(shard_kmers), return_inverse=True)
+            counts = numpy.zeros(len(kmers), dtype=numpy.int64)
+            numpy.add.at(counts, shard_kmer_idx, numpy.concatenate(shard_kmer_counts))
+        else:
+            kmers, counts = _count_kmers(seq_strs, kmer_size, single_strand)
+
+        keep = numpy.ones(len(kmers), dtype=bool)
+        if min_occs:
+            keep &= counts >= min_occs
+        if max_occs:
+            keep &= counts <= max_occs
+        if counter_cap:
+            counts = numpy.minimum(counts, counter_cap)
+        # fill the result directly from (kmer, count) pairs, rather than building an intermediate dict to copy from
+        kmer_counts = collections.Counter()
+        dict.update(kmer_counts, zip(self._kmers_as_strs(kmers[keep], kmer_size), counts[keep].tolist()))
+        return kmer_counts
 
     def _filter_kmer_counts(self, counts, min_occs=None, max_occs=None, counter_cap=None):
         """From a dict of kmer counts, drop kmers with counts below `min_occs` or above `max_occs`, and
@@ -156,9 +271,18 @@ class KmcPy(object):
                                     (count <= (max_occs or count))})
 
 
+    def compute_reads_kmers(self, in_reads, kmer_size, single_strand):
+        """Return a list containing, for each read in `in_reads`, a tuple (read id, read length, kmers of read).
+        The kmers of each read are given as strs, with each occurrence included and canonicalized unless
+        `single_strand` is True.  The result depends only on the reads and the kmer params, so can be shared
+        by filter_reads() calls with different thresholds."""
+        return [(rec.id, len(rec.seq),
+                 tuple(self._kmers_as_strs(self._compute_seq_kmers(str(rec.seq), kmer_size, single_strand), kmer_size)))
+                for rec in _yield_seq_recs(in_reads)]
+
     def filter_reads(self, db_kmer_counts, in_reads, kmer_size, single_strand,
                     db_min_occs, db_max_occs, read_min_occs, read_max_occs,
-                    read_min_occs_frac, read_max_occs_frac, **ignore):
+                    read_min_occs_frac, read_max_occs_frac, reads_kmers=None, **ignore):
         """Fiter sequences based on their kmer contents; returns the ids of the passing seqs.
 
         Inputs:
@@ -176,40 +300,48 @@ class KmcPy(object):
              interpreted as a fraction of read length in kmers
            read_max_occs_frac: only keep reads with no more than this many occurrence of kmers from the database.
              interpreted as a fraction of read length in kmers.
+           reads_kmers: if given, the result of compute_reads_kmers() for in_reads, kmer_size and single_strand
         """
-        db_kmers = self._filter_kmer_counts(counts=db_kmer_counts, min_occs=db_min_occs, max_occs=db_max_occs).keys()
+        db_kmers = frozenset(self._filter_kmer_counts(counts=db_kmer_counts,
+                                                      min_occs=db_min_occs, max_occs=db_max_occs))
 
         seqs_ids_out = set()
         rel_thresholds = (read_min_occs_frac, read_max_occs_frac) != (0., 1.)
-        in_recs = _list_seq_recs(in_reads)
+        if reads_kmers is None:
+            reads_kmers = self.compute_reads_kmers(in_reads, kmer_size, single_strand)
 
         seq_occs_hist = collections.Counter()
         mate_cnt = collections.Counter()
 
-        for rec in in_recs:
-            seq = str(rec.seq)
-            seq_kmer_counts = self.compute_kmer_counts(seq, kmer_size=kmer_size, single_strand=single_strand,
-                                                       min_occs=1, max_occs=util.misc.MAX_INT32,
-                                                       counter_cap=util.misc.MAX_INT32)
+        for read_id, read_len, read_kmers in reads_kmers:
             assert not single_strand
-            seq_occs = sum([seq_count for kmer, seq_count in seq_kmer_counts.items() \
-                            if kmer in db_kmers])
-            seq_occs_hist[seq_occs] += 1
-
             if rel_thresholds:
-                n_seq_kmers = len(seq)-kmer_size+1
+                n_seq_kmers = read_len-kmer_size+1
                 read_min_occs_seq, read_max_occs_seq = (int(read_min_occs_frac * n_seq_kmers),
                                                         int(read_max_occs_frac * n_seq_kmers))
             else:
                 read_min_occs_seq, read_max_occs_seq = (read_min_occs, read_max_occs)
 
+            # count occurrences of db kmers in the read.  if the read could exceed read_max_occs_seq,
+            # stop counting once it does; otherwise, count all occurrences with set lookups done in C.
+            if read_max_occs_seq >= len(read_kmers):
+                seq_occs = sum(map(db_kmers.__contains__, read_kmers))
+            else:
+                seq_occs = 0
+                for kmer in read_kmers:
+                    if kmer in db_kmers:
+                        seq_occs += 1
+                        if seq_occs > read_max_occs_seq:
+                            break
+            seq_occs_hist[seq_occs] += 1
+
             if read_min_occs_seq <= seq_occs <= read_max_occs_seq:
-                seqs_ids_out.add(rec.id)
-                mate_cnt[rec.id[-2:] if rec.id[-2:] in ('/1', '/2') else '/0'] += 1
+                seqs_ids_out.add(read_id)
+                mate_cnt[read_id[-2:] if read_id[-2:] in ('/1', '/2') else '/0'] += 1
 
 
-        _log.debug('kmer occs histogram: %s', sorted(seq_occs_hist.items()))
-        _log.debug('filter_reads: %d of %d passed; mate_cnt=%s', len(seqs_ids_out), len(in_recs),
+        _log.debug('kmer occs histogram (counts above a read\'s max occs truncated): %s', sorted(seq_occs_hist.items()))
+        _log.debug('filter_reads: %d of %d passed; mate_cnt=%s', len(seqs_ids_out), len(reads_kmers),
                    mate_cnt)
 
         return seqs_ids_out
@@ -221,10 +353,10 @@ class KmcPy(object):
             result = kmer_counts_1 & kmer_counts_2
         elif op == 'union':
             result = collections.Counter({k: (kmer_counts_1[k] + kmer_counts_2[k])
-                                          for k in (set(kmer_counts_1.keys()) | set(kmer_counts_2.keys()))})
+                                          for k in (kmer_counts_1.keys() | kmer_counts_2.keys())})
         elif op == 'kmers_subtract':
             result = collections.Counter(util.misc.subdict(kmer_counts_1,
-                                                           set(kmer_counts_1.keys()) - set(kmer_counts_2.keys())))
+                                                           kmer_counts_1.keys() - kmer_counts_2.keys()))
         elif op == 'counters_subtract':
             result = kmer_counts_1 - kmer_counts_2
         else:
@@ -235,9 +367,16 @@ class KmcPy(object):
 
 kmcpy = KmcPy()
 
+def _count_kmers(seq_strs, kmer_size, single_strand):
+    """Return the distinct kmers of seq(s), represented as by KmcPy._compute_kmers(), and their counts, as a pair
+    of arrays.  Defined at module level so that it can be run in worker processes."""
+    return numpy.unique(kmcpy._compute_kmers(seq_strs, kmer_size, single_strand), return_counts=True)
+
+_INPUT_DIR = os.path.join(util.file.get_test_input_path(), 'TestKmers')
+
 def _inp(fname):
     """Return full path to a test input file for this module"""
-    return os.path.join(util.file.get_test_input_path(), 'TestKmers', fname)
+    return os.path.join(_INPUT_DIR, fname)
 
 def _stringify(arg):
     """Return a string based on `arg`, suitable for use as a pytest test id"""
@@ -305,10 +444,20 @@ def kmer_db_fixture2(request, tmpdir_module, dict_module):
 
 @pytest.mark.parametrize("kmer_db_fixture", KMER_DBS_EMPTY+KMER_DBS_SMALL+KMER_DBS_MEDIUM,
                          ids=_stringify, indirect=["kmer_db_fixture"])
-def test_build_kmer_db(kmer_db_fixture):
-    _test_build_kmer_db(kmer_db_fixture)
-
-def _test_build_kmer_db(kmer_db_fixture):
+def test_build_kmer_db(kmer_db_fixture, dict_module):
+    _test_build_kmer_db(kmer_db_fixture, dict_module)
+
+def _get_kmcpy_kmer_counts(val_cache, kmer_db_args):
+    """Return kmcpy.compute_kmer_counts() for the given build_kmer_db args.  The counts do not depend on args such as
+    thread count or memory limits, so they are cached in the dict `val_cache` keyed only by the args that affect them,
+    for reuse by tests that differ only in the other args."""
+    key = ('kmcpy_kmer_counts', tuple(util.misc.make_seq(kmer_db_args.seq_files)), kmer_db_args.kmer_size,
+           kmer_db_args.min_occs, kmer_db_args.max_occs, kmer_db_args.counter_cap, kmer_db_args.single_strand)
+    if key not in val_cache:
+        val_cache[key] = kmcpy.compute_kmer_counts(**vars(kmer_db_args))
+    return val_cache[key]
+
+def _test_build_kmer_db(kmer_db_fixture, dict_module):
     assert tools.kmc.KmcTool().is_kmer_db(kmer_db_fixture.kmer_db)
 
     kmer_db_info = tools.kmc.KmcTool().get_kmer_db_info(kmer_db_fixture.kmer_db)
@@ -316,7 +465,7 @@ def _test_build_kmer_db(kmer_db_fixture):
     assert kmer_db_info.min_occs == kmer_db_fixture.kmer_db_args.min_occs
     assert kmer_db_info.max_occs == kmer_db_fixture.kmer_db_args.max_occs
 
-    kmcpy_kmer_counts = kmcpy.compute_kmer_counts(**vars(kmer_db_fixture.kmer_db_args))
+    kmcpy_kmer_counts = _get_kmcpy_kmer_counts(dict_module, kmer_db_fixture.kmer_db_args)
     assert kmer_db_info.total_kmers == len(kmcpy_kmer_counts)
     assert kmer_db_fixture.kmc_kmer_counts == kmcpy_kmer_counts
 
@@ -344,13 +493,21 @@ COMBO_OPTS = [(seq_file, '-k{} {} {} --threads {}'.format(kmer_size, strand_opt,
 
 @pytest.mark.slow
 @pytest.mark.parametrize("kmer_db_fixture", COMBO_OPTS, ids=_stringify, indirect=["kmer_db_fixture"])
-def test_build_kmer_db_combo(kmer_db_fixture):
-    _test_build_kmer_db(kmer_db_fixture)
+def test_build_kmer_db_combo(kmer_db_fixture, dict_module):
+    _test_build_kmer_db(kmer_db_fixture, dict_module)
 
 
 ##############################################################################################
 
-def _test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function):
+def _get_reads_kmers(val_cache, reads_file, kmer_size, single_strand):
+    """Return kmcpy.compute_reads_kmers() for the given reads.  The kmers of reads do not depend on filtering
+    thresholds, so they are computed once and cached in the dict `val_cache` for reuse by other tests."""
+    key = ('reads_kmers', reads_file, kmer_size, single_strand)
+    if key not in val_cache:
+        val_cache[key] = kmcpy.compute_reads_kmers(reads_file, kmer_size, single_strand)
+    return val_cache[key]
+
+def _test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function, dict_module):
     """Test read filtering.
 
     Args:
@@ -370,27 +527,29 @@ def _test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function
                                          reads_file, reads_file_out] + filter_opts.split()).args_parsed
 
     _log.debug('Running filte: kmer_db_args=%s filter_arg=%s', kmer_db_fixture.kmer_db_args, filter_args)
+    kmer_size = kmer_db_fixture.kmer_db_args.kmer_size
+    single_strand = kmer_db_fixture.kmer_db_args.single_strand
+    reads_kmers = _get_reads_kmers(dict_module, reads_file, kmer_size, single_strand)
     filtered_ids_expected = kmcpy.filter_reads(db_kmer_counts=kmer_db_fixture.kmc_kmer_counts,
-                                               kmer_size=kmer_db_fixture.kmer_db_args.kmer_size,
-                                               single_strand=kmer_db_fixture.kmer_db_args.single_strand,
-                                               **vars(filter_args))
+                                               kmer_size=kmer_size, single_strand=single_strand,
+                                               reads_kmers=reads_kmers, **vars(filter_args))
 
     reads_file_out_ids_txt = reads_file_out+'.ids.txt'
     read_utils.read_names(reads_file_out, reads_file_out_ids_txt)
     reads_out_ids = util.file.slurp_file(reads_file_out_ids_txt).strip().split()
 
-    _log.debug('FILT %d %d %s %s %s', len(_list_seq_recs(reads_file)), len(_list_seq_recs(reads_file_out)),
+    _log.debug('FILT in=%d out_names=%d %s %s %s', len(reads_kmers), len(reads_out_ids),
                kmer_db_fixture.kmer_db, reads_file, filter_opts)
     def normed_read_ids(ids): return set(map(_strip_mate_num, ids))
 
     assert normed_read_ids(reads_out_ids) == normed_read_ids(filtered_ids_expected)
 
-# end: def _test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function)
+# end: def _test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function, dict_module)
 
 @pytest.mark.parametrize("kmer_db_fixture", [('empty.fasta', '')], ids=_stringify, indirect=["kmer_db_fixture"])
 @pytest.mark.parametrize("reads_file", ['empty.fasta', 'tcgaattt.fasta', 'G5012.3.subset.bam'])
 @pytest.mark.parametrize("filter_opts", ['', '--readMinOccs 1', '--readMaxOccs 2'])
-def test_filter_with_empty_db(kmer_db_fixture, reads_file, filter_opts, tmpdir_function):
+def test_filter_with_empty_db(kmer_db_fixture, reads_file, filter_opts, tmpdir_function, dict_module):
     _test_filter_reads(**locals())
 
 @pytest.mark.parametrize("kmer_db_fixture", [('ebola.fasta.gz', '-k 7')], ids=_stringify, indirect=["kmer_db_fixture"])
@@ -399,7 +558,7 @@ def test_filter_with_empty_db(kmer_db_fixture, reads_file, filter_opts, tmpdir_f
 @pytest.mark.parametrize("filter_opts", ['--dbMinOccs 7  --readMinOccs 93',
                                          '--dbMinOccs 4 --readMinOccsFrac .6',
                                          '--readMinOccsFrac .4 --readMaxOccsFrac .55'])
-def test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function):
+def test_filter_reads(kmer_db_fixture, reads_file, filter_opts, tmpdir_function, dict_module):
     _test_filter_reads(**locals())
 
 
@@ -410,7 +569,7 @@ def test_kmer_set_counts(kmer_db_fixture, tmpdir_function, set_to_val):
     util.cmd.run_cmd(module=kmer_utils, cmd='kmers_set_counts',
                      args=[kmer_db_fixture.kmer_db, set_to_val, db_with_set_counts])
     new_counts = tools.kmc.KmcTool().get_kmer_counts(db_with_set_counts)
-    assert set(new_counts.keys()) == set(kmer_db_fixture.kmc_kmer_counts.keys())
+    assert new_counts.keys() == kmer_db_fixture.kmc_kmer_counts.keys()
     assert not new_counts  or  set(new_counts.values()) == set([set_to_val])
 
 
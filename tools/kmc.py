@@ -240,7 +240,9 @@ class KmcTool(tools.Tool):
                 # kmc_tools filter currently requires fasta files to be in fasta-2line format
                 # https://github.com/refresh-bio/KMC/issues/57
                 _in_reads = os.path.join(t_dir, 'in_reads.fasta')
-                Bio.SeqIO.convert(in_reads, 'fasta', _in_reads, 'fasta-2line')
+                with util.file.open_or_gzopen(in_reads, 'rt') as in_reads_f, open(_in_reads, 'wt') as out_f:
+                    for title, seq in Bio.SeqIO.FastaIO.SimpleFastaParser(in_reads_f):
+                        out_f.write('>{}\n{}\n'.format(title, seq))
             if in_reads_type == '.bam':
                 # kmc_tools filter currently does not support .bam files
                 # https://github.com/refresh-bio/KMC/issues/66